@@ -23,6 +23,21 @@ BREAKFAST = 11
 LUNCH = 16
 AFTERNOON = 19
 
+# CHECKPOINTS params
+# Location of stage checkpoints: local ('/tmp/operations-l3/checkpoints') or S3 prefix
+# ('s3://bucket/prefix/'). None disables checkpoints, could be overridden by event.
+CHECKPOINT_PATH = None
+# Stage outputs format: "parquet" or "arrow" (Arrow IPC)
+CHECKPOINT_FORMAT = "parquet"
+
+# PLANNER params
+# In memory size estimated as Parquet size * factor (decompression, merge and copies)
+PLANNER_EXPANSION_FACTOR = 10
+# Fraction of available memory usable by the run
+PLANNER_MEMORY_FRACTION = 0.6
+# Max processes for parallel strategy
+PLANNER_MAX_WORKERS = 6
+
 # AWS_ACCOUNT_ID
 AWS_ACCOUNT_ID = "984752346791"
 
@@ -0,0 +1,148 @@
+import logging
+import datetime
+import hashlib
+import boto3
+import json
+import io
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import settings
+
+
+class StageCheckpoint(object):
+    """
+    Class for persist stage outputs (dataframes) and completed stages of a run.
+
+    Checkpoints are stored under "<base_path>/<run_key>/", base_path could be
+    a local directory (e.g. /tmp/...) or a S3 prefix (s3://bucket/prefix/).
+    The run_key is built from run params and the inputs fingerprint, so a retry
+    with the same inputs resumes from the last completed stage.
+
+    If base_path is None every method is a no-op (checkpoints disabled).
+
+    returns dataframes of completed stages
+    """
+    MANIFEST = "manifest.json"
+    FORMATS = { "parquet": ".parquet", "arrow": ".arrow" }
+
+    def __init__(self, base_path=None, dparams=None, fingerprint="", fmt=None):
+        self.enabled = bool(base_path)
+        self.fmt = (fmt or settings.CHECKPOINT_FORMAT).lower()
+        if self.fmt not in self.FORMATS:
+            raise ValueError(f"Checkpoint format { self.fmt } not supported, use one of { list(self.FORMATS) }")
+
+        dparams = dparams or {}
+        key = json.dumps({ "params": dparams, "fingerprint": fingerprint }, sort_keys=True, default=str)
+        self.run_key = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        self.path = f"{ (base_path or '').rstrip('/') }/{ self.run_key }"
+
+        self.manifest = { "params": dparams, "fingerprint": fingerprint, "stages": {} }
+        if self.enabled:
+            dmanifest = self._read_manifest()
+            if dmanifest:
+                self.manifest = dmanifest
+
+    def is_done(self, stage):
+        """
+            Stage already completed in a previous execution
+
+            return:
+                bool
+        """
+        return self.enabled and stage in self.manifest["stages"]
+
+    def mark_done(self, stage, **kwargs):
+        """
+            Record stage as completed (without output)
+
+            Failures are logged and ignored, checkpoints never break a run.
+        """
+        if not self.enabled:
+            return
+        logger = logging.getLogger(__name__)
+
+        self.manifest["stages"][stage] = dict(kwargs, done_at=datetime.datetime.now().isoformat())
+        try:
+            self._write_manifest()
+        except Exception as err:
+            logger.warning(f"Failed while trying to save Checkpoint manifest ({ stage }): {err}")
+
+    def save(self, stage, df):
+        """
+            Persist stage output and record stage as completed.
+
+            Failures are logged and ignored, checkpoints never break a run.
+        """
+        if not self.enabled:
+            return
+        logger = logging.getLogger(__name__)
+
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            buffer = io.BytesIO()
+            if self.fmt == "arrow":
+                with pa.ipc.new_file(buffer, table.schema) as writer:
+                    writer.write_table(table)
+            else:
+                pq.write_table(table, buffer)
+            file_name = stage + self.FORMATS[self.fmt]
+            self._write_bytes(file_name, buffer.getvalue())
+            self.mark_done(stage, file=file_name, rows=len(df))
+            logger.info(f"Checkpoint { stage } saved in { self.path }")
+        except Exception as err:
+            logger.warning(f"Failed while trying to save Checkpoint { stage }: {err}")
+
+    def load(self, stage):
+        """
+            Get output of a completed stage
+
+            return:
+                df: dataframe, None if stage was not completed or can not be read
+        """
+        if not self.is_done(stage) or "file" not in self.manifest["stages"][stage]:
+            return None
+        logger = logging.getLogger(__name__)
+
+        try:
+            file_name = self.manifest["stages"][stage]["file"]
+            buffer = pa.BufferReader(self._read_bytes(file_name))
+            if file_name.endswith(self.FORMATS["arrow"]):
+                table = pa.ipc.open_file(buffer).read_all()
+            else:
+                table = pq.read_table(buffer)
+            logger.info(f"Checkpoint { stage } loaded from { self.path }")
+            return table.to_pandas()
+        except Exception as err:
+            logger.warning(f"Failed while trying to load Checkpoint { stage }: {err}")
+            return None
+
+    def _read_manifest(self):
+        try:
+            return json.loads(self._read_bytes(self.MANIFEST).decode("utf-8"))
+        except Exception:
+            return None
+
+    def _write_manifest(self):
+        self._write_bytes(self.MANIFEST, json.dumps(self.manifest, default=str).encode("utf-8"))
+
+    def _write_bytes(self, file_name, data):
+        path = f"{ self.path }/{ file_name }"
+        if path.startswith("s3://"):
+            bucket, _, key = path.replace("s3://", "").partition("/")
+            boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=data)
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+
+    def _read_bytes(self, file_name):
+        path = f"{ self.path }/{ file_name }"
+        if path.startswith("s3://"):
+            bucket, _, key = path.replace("s3://", "").partition("/")
+            return boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+        with open(path, "rb") as f:
+            return f.read()
@@ -0,0 +1,281 @@
+import logging
+
+import pandas as pd
+
+from sqlalchemy import inspect, text
+
+
+# Dimension tables: surrogate key and natural attributes (column: postgres type)
+DDIMENSIONS = {
+    'dim_ops_branch': {
+        'key': 'branch_key',
+        'columns': { 'branch_id': 'BIGINT', 'branch_name': 'TEXT' }
+    },
+    'dim_ops_brand': {
+        'key': 'brand_key',
+        'columns': { 'brand_id': 'BIGINT', 'brand_name': 'TEXT' }
+    },
+    'dim_ops_product': {
+        'key': 'product_key',
+        'columns': { 'product_name': 'TEXT' }
+    },
+    'dim_ops_option': {
+        'key': 'option_key',
+        'columns': { 'score_option': 'TEXT' }
+    },
+    'dim_ops_slot': {
+        'key': 'slot_key',
+        'columns': { 'weekday': 'INTEGER', 'day_name': 'TEXT', 'slot_time': 'TEXT',
+                     'is_weekend': 'BOOLEAN', 'is_week': 'BOOLEAN', 'slot_weektime': 'TEXT' }
+    }
+}
+
+
+# Fact tables with surrogate keys (column: postgres type)
+LSCORES = { f'score_{x}': 'BIGINT' for x in range(1, 6) }
+DFACTS = {
+    'fct_ops_orders_score_slottime_keys': {
+        'branch_key': 'INTEGER', 'brand_key': 'INTEGER', 'slot_key': 'INTEGER',
+        'date': 'TIMESTAMP', 'country': 'TEXT', 'app': 'TEXT',
+        'n_orders': 'BIGINT', **LSCORES, 'score_n_orders': 'BIGINT'
+    },
+    'fct_ops_orders_score_slottime_options_keys': {
+        'branch_key': 'INTEGER', 'brand_key': 'INTEGER', 'option_key': 'INTEGER', 'slot_key': 'INTEGER',
+        'date': 'TIMESTAMP', 'country': 'TEXT', 'app': 'TEXT',
+        'n_reviews': 'BIGINT', **LSCORES
+    },
+    'fct_ops_orders_score_slottime_products_keys': {
+        'branch_key': 'INTEGER', 'brand_key': 'INTEGER', 'product_key': 'INTEGER', 'slot_key': 'INTEGER',
+        'date': 'TIMESTAMP', 'country': 'TEXT', 'app': 'TEXT',
+        'n_reviews': 'BIGINT', **LSCORES
+    }
+}
+
+
+class DimensionLookup(object):
+    """
+    Class for maintain Dimension tables with surrogate keys (dim_ops_***)
+
+
+    Dimensions are cached in memory once per run, new members of every fact
+    dataframe are bulk-upserted together and then resolved to their keys.
+
+    returns fact dataframes with surrogate keys instead of dimension attributes
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.cache = {}
+
+
+    def create_tables(self):
+        """
+            Create Dimension tables if not exists
+        """
+        with self.engine.begin() as conn:
+            # Concurrent first runs wait here instead of failing on IF NOT EXISTS
+            conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), { "name": "dim_ops" })
+            for dim_table, ddim in DDIMENSIONS.items():
+                columns = ", ".join(f"{x} {t}" for x, t in ddim['columns'].items())
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {dim_table} ("
+                             f"{ddim['key']} SERIAL PRIMARY KEY, {columns}, "
+                             f"UNIQUE ({', '.join(ddim['columns'])}))")
+
+
+    def load(self):
+        """
+            Get Dimension tables in memory cache
+        """
+        for dim_table, ddim in DDIMENSIONS.items():
+            lcolumns = list(ddim['columns'])
+            df_dim = pd.read_sql(f"SELECT {ddim['key']}, {', '.join(lcolumns)} FROM {dim_table}", self.engine)
+            df_dim[lcolumns] = self._cast(df_dim[lcolumns], ddim)
+            self.cache[dim_table] = df_dim
+
+
+    def upsert(self, ldfs):
+        """
+            Insert new Dimension members found in fact dataframes (one bulk insert by dimension)
+
+            return:
+                dict: StatusCode and message
+        """
+        logger = logging.getLogger(__name__)
+
+        try:
+            self.create_tables()
+            self.load()
+
+            with self.engine.begin() as conn:
+                for dim_table, ddim in DDIMENSIONS.items():
+                    lcolumns = list(ddim['columns'])
+                    lframes = [self._cast(df[lcolumns], ddim) for df in ldfs if set(lcolumns) <= set(df.columns)]
+                    if not lframes:
+                        continue
+
+                    df_new = pd.concat(lframes, ignore_index=True).dropna().drop_duplicates()
+                    df_new = pd.merge(df_new, self.cache[dim_table], how="left", on=lcolumns)
+                    df_new = df_new[df_new[ddim['key']].isna()][lcolumns]
+                    if df_new.empty:
+                        continue
+
+                    logger.info(f"Inserting { len(df_new) } new members in { dim_table }")
+                    # Direct insert (executemany), concurrent runs only meet on the unique constraint
+                    columns = ", ".join(lcolumns)
+                    values = ", ".join(f":{x}" for x in lcolumns)
+                    conn.execute(text(f"INSERT INTO {dim_table} ({columns}) VALUES ({values}) "
+                                      f"ON CONFLICT ({columns}) DO NOTHING"),
+                                 df_new.astype(object).to_dict('records'))
+
+            self.load()
+            return { "StatusCode": 200, "message": "Dimensions OK" }
+        except Exception as err:
+            return { "StatusCode": 500, "message": f"Failed while trying to Upsert Dimensions {err}" }
+
+
+    def resolve(self, df):
+        """
+            Replace Dimension attributes by their surrogate keys
+
+            return:
+                df: dataframe
+        """
+        df_ = df.copy()
+        lkeys = []
+        for dim_table, ddim in DDIMENSIONS.items():
+            lcolumns = list(ddim['columns'])
+            if not set(lcolumns) <= set(df_.columns):
+                continue
+            df_[lcolumns] = self._cast(df_[lcolumns], ddim)
+            df_ = pd.merge(df_, self.cache[dim_table], how="left", on=lcolumns)
+            df_[ddim['key']] = df_[ddim['key']].astype('Int64')
+            df_ = df_.drop(lcolumns, axis=1)
+            lkeys.append(ddim['key'])
+
+        return df_[lkeys + [x for x in df_.columns if x not in lkeys]]
+
+
+    def _cast(self, df, ddim):
+        df = df.copy()
+        for column, column_type in ddim['columns'].items():
+            if column_type in ('BIGINT', 'INTEGER'):
+                df[column] = pd.to_numeric(df[column])
+            elif column_type == 'BOOLEAN':
+                df[column] = df[column].astype(bool)
+            else:
+                df[column] = df[column].astype(object)
+        return df
+
+
+def create_fact_views(engine, dviews):
+    """
+    Create views with the wide shape (dimension attributes) over fact tables with keys.
+
+    Legacy wide tables with the same name as a view are kept renamed
+    (<name>_legacy), once their rows are backfilled into the fact table (see
+    backfill_fact_table) so views keep the whole history. Every fact table
+    must exist, otherwise no view is changed.
+
+    Parameters
+    ----------
+    engine : sqlalchemy engine
+    dviews : dict { view_name: fact_table }
+
+    Returns
+    -------
+    dict.
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
+        dkeys = { ddim['key']: (dim_table, ddim) for dim_table, ddim in DDIMENSIONS.items() }
+        dimensions = DimensionLookup(engine)
+
+        with engine.begin() as conn:
+            # Concurrent runs wait here, so only the first one finds the legacy tables
+            conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), { "name": "fct_ops_views" })
+            inspector = inspect(conn)
+            ltables = inspector.get_table_names()
+
+            for view_name, fact_table in dviews.items():
+                if fact_table not in ltables:
+                    raise ValueError(f"Fact table { fact_table } not found for view { view_name }")
+                if view_name in ltables:
+                    backfill_fact_table(conn, dimensions, view_name, fact_table)
+                    logger.warning(f"Legacy table { view_name } renamed to { view_name }_legacy")
+                    conn.execute(f"ALTER TABLE {view_name} RENAME TO {view_name}_legacy")
+
+                lselect, ljoins = [], []
+                for column in [x['name'] for x in inspector.get_columns(fact_table)]:
+                    if column in dkeys:
+                        dim_table, ddim = dkeys[column]
+                        lselect += [f"{dim_table}.{x}" for x in ddim['columns']]
+                        ljoins.append(f"LEFT JOIN {dim_table} ON {dim_table}.{column} = f.{column}")
+                    else:
+                        lselect.append(f"f.{column}")
+
+                conn.execute(f"DROP VIEW IF EXISTS {view_name}")
+                conn.execute(f"CREATE VIEW {view_name} AS SELECT {', '.join(lselect)} "
+                             f"FROM {fact_table} f {' '.join(ljoins)}")
+
+        return { "StatusCode": 200, "message": "Views OK" }
+    except Exception as err:
+        return { "StatusCode": 500, "message": f"Failed while trying to create Views {err}" }
+
+
+def backfill_fact_table(conn, dimensions, legacy_table, fact_table):
+    """
+    Insert rows of a legacy wide table into its fact table with keys.
+
+    Only dates before the first date already loaded in the fact table are taken
+    (every row if it is empty). Dimension members of those rows are upserted
+    and rows are inserted with their keys (INSERT ... SELECT joining dimensions).
+
+    Parameters
+    ----------
+    conn : sqlalchemy connection (transaction of create_fact_views)
+    dimensions : DimensionLookup
+    legacy_table : wide table (dimension attributes)
+    fact_table : table with surrogate keys
+
+    Returns
+    -------
+    int. rows inserted
+    """
+    logger = logging.getLogger(__name__)
+
+    inspector = inspect(conn)
+    llegacy = [x['name'] for x in inspector.get_columns(legacy_table)]
+    lfacts = [x['name'] for x in inspector.get_columns(fact_table)]
+
+    date_to = conn.execute(f"SELECT MIN(date) FROM {fact_table}").scalar()
+    where = "" if date_to is None else " WHERE l.date < :date_to"
+    dparams = {} if date_to is None else { "date_to": date_to }
+
+    # Dimensions of the fact table that can be resolved from legacy attributes
+    ddims = { ddim['key']: (dim_table, ddim) for dim_table, ddim in DDIMENSIONS.items()
+              if ddim['key'] in lfacts and set(ddim['columns']) <= set(llegacy) }
+
+    ldfs = [pd.read_sql(text(f"SELECT DISTINCT {', '.join(ddim['columns'])} FROM {legacy_table} l{where}"),
+                        conn, params=dparams) for _, ddim in ddims.values()]
+    dresponse = dimensions.upsert(ldfs)
+    if dresponse['StatusCode'] != 200:
+        raise ValueError(dresponse['message'])
+
+    lcolumns, lselect, ljoins = [], [], []
+    for column in lfacts:
+        if column in ddims:
+            dim_table, ddim = ddims[column]
+            lselect.append(f"{dim_table}.{column}")
+            ljoins.append(f"LEFT JOIN {dim_table} ON " +
+                          " AND ".join(f"{dim_table}.{x} = l.{x}" for x in ddim['columns']))
+        elif column in llegacy:
+            lselect.append(f"l.{column}")
+        else:
+            continue
+        lcolumns.append(column)
+
+    result = conn.execute(text(f"INSERT INTO {fact_table} ({', '.join(lcolumns)}) "
+                               f"SELECT {', '.join(lselect)} FROM {legacy_table} l {' '.join(ljoins)}{where}"),
+                          dparams)
+    logger.info(f"{ result.rowcount } rows of { legacy_table } backfilled in { fact_table }")
+    return result.rowcount
@@ -0,0 +1,230 @@
+import logging
+import multiprocessing
+
+import pandas as pd
+
+from functions.loadings import \
+    get_rappi_orders_reviews, \
+    get_order_product_detail, \
+    read_parquet_objects
+from functions.planner import get_orders_chunks
+from functions.transformations import \
+    process_orders_slot_time, \
+    process_orders_reviews, \
+    process_orders_reviews_errors, \
+    process_orders_reviews_products
+
+
+# Aggregation by fact table. Products are not filtered here: the filter needs
+# every date of a product, so it is applied once aggregations are complete.
+DAGGREGATIONS = {
+    'fct_ops_orders_score_slottime': process_orders_reviews,
+    'fct_ops_orders_score_slottime_options': process_orders_reviews_errors,
+    'fct_ops_orders_score_slottime_products': lambda df: process_orders_reviews_products(df, fg_filter=False)
+}
+
+# Additive metrics of the aggregations, every other column is a group key
+LMETRICS = ["n_orders", "n_reviews", "score_1", "score_2", "score_3", "score_4", "score_5"]
+
+
+def get_orders_slot_time(country, app, fg_history, dobjects=None):
+    """
+    Get Orders Detail with Reviews and Slottime features.
+
+    Args:
+        country: country
+        app: app ["RP", "PY"]
+        fg_history: [0, 1]
+        dobjects: dict with listed objects by source ('reviews', 'orders'), see get_inputs_fingerprint
+
+    Returns:
+        dict: Dictionary
+            'StatusCode': [200, 500]
+            'df': df.dataframe
+    """
+    logger = logging.getLogger(__name__)
+
+    # Call to get orders detail, from the listed objects (the ones in the inputs fingerprint)
+    lpaths = [x["path"] for x in (dobjects or {}).get("orders", [])] or None
+    dOrdersResponse = get_order_product_detail(country, app, fg_history, lpaths)
+    logger.info(dOrdersResponse["message"])
+    if dOrdersResponse['StatusCode'] != 200:
+        return { "StatusCode": 500, "message": "ERROR while trying to get Reviews or Orders" }
+
+    # Call to get reviews, only for loaded orders
+    dReviewsResponse = get_rappi_orders_reviews(country, fg_history, dOrdersResponse['df'],
+                                                (dobjects or {}).get("reviews"))
+    logger.info(dReviewsResponse["message"])
+    if dReviewsResponse['StatusCode'] != 200:
+        return { "StatusCode": 500, "message": "ERROR while trying to get Reviews or Orders" }
+
+    df = pd.merge(dOrdersResponse['df'], dReviewsResponse['df'], how="left", on="order_id")
+    # Process Slottime
+    return process_orders_slot_time(df)
+
+
+def process_orders_aggregations(df, ltables):
+    """
+    Get aggregations of Orders with Reviews and Slottime for each fact table.
+
+    Args:
+        df: dataframe with orders, reviews and slottime features
+        ltables: list of fact tables (keys of DAGGREGATIONS)
+
+    Returns:
+        dict: Dictionary
+            'StatusCode': [200, 500]
+            'dfs': { table_name: df.dataframe }
+    """
+    dfs = {}
+    for table_name in ltables:
+        dresponse = DAGGREGATIONS[table_name](df)
+        if dresponse['StatusCode'] != 200:
+            return dresponse
+        dfs[table_name] = dresponse['df']
+    return { "StatusCode": 200, "dfs": dfs }
+
+
+def merge_orders_aggregations(ldfs):
+    """
+    Concat aggregations of several chunks and group them again.
+
+    Chunks are month partitions of Orders Detail but the date of the groups comes
+    from created_datetime, so a group could be split between two chunks.
+
+    Args:
+        ldfs: list of dataframes of the same fact table (see process_orders_aggregations)
+
+    Returns:
+        df: dataframe
+    """
+    df = pd.concat(ldfs, ignore_index=True)
+    lmetrics = [x for x in LMETRICS if x in df.columns]
+    lgroups = [x for x in df.columns if x not in lmetrics]
+    if not lgroups or df.empty:
+        return df
+
+    # Categories could differ between chunks
+    for column in df[lgroups].select_dtypes('category').columns:
+        df[column] = df[column].astype(object)
+    return df.groupby(lgroups, sort=False, dropna=False)[lmetrics].sum().reset_index()[list(df.columns)]
+
+
+def process_orders_chunk(df_reviews, country, app, fg_history, year_month, lpaths, ltables):
+    """
+    Get aggregations for one month of Orders Detail.
+
+    Args:
+        df_reviews: dataframe with reviews of the whole window (see get_rappi_orders_reviews)
+        country: country
+        app: app ["RP", "PY"]
+        fg_history: [0, 1]
+        year_month: "YYYY-MM", orders month partition
+        lpaths: list of S3 objects paths of the month
+        ltables: list of fact tables (keys of DAGGREGATIONS)
+
+    Returns:
+        dict: Dictionary
+            'StatusCode': [200, 500]
+            'dfs': { table_name: df.dataframe }
+    """
+    logger = logging.getLogger(__name__)
+
+    dOrdersResponse = get_order_product_detail(country, app, fg_history, lpaths)
+    logger.info(f"{ year_month }: { dOrdersResponse['message'] }")
+    if dOrdersResponse['StatusCode'] != 200:
+        return dOrdersResponse
+
+    df = pd.merge(dOrdersResponse['df'], df_reviews, how="left", on="order_id")
+    dresponse = process_orders_slot_time(df)
+    if dresponse['StatusCode'] != 200:
+        return dresponse
+
+    return process_orders_aggregations(dresponse['df'], ltables)
+
+
+def _process_orders_chunk_worker(conn, *args):
+    """
+        Run process_orders_chunk in a child process and send the response through the pipe
+    """
+    try:
+        conn.send(process_orders_chunk(*args))
+    except Exception as err:
+        conn.send({ "StatusCode": 500, "message": f"Failed while trying to process Orders chunk {err}" })
+    finally:
+        conn.close()
+
+
+def process_orders_by_chunks(country, app, fg_history, dplan, dobjects, ltables):
+    """
+    Get aggregations streaming Orders Detail by month (chunked and parallel strategies).
+
+    Reviews are read once for the whole window, only for the orders of the listed
+    objects (semi-join on order_id, read as a single column). With "parallel" strategy
+    up to dplan['n_workers'] months are processed at the same time in child processes
+    (Process and Pipe, as Lambda has no shared memory for multiprocessing.Pool), which
+    share the reviews dataframe (fork).
+
+    Args:
+        country: country
+        app: app ["RP", "PY"]
+        fg_history: [0, 1]
+        dplan: execution plan (see plan_execution)
+        dobjects: dict with listed objects by source ('reviews', 'orders'), see get_inputs_fingerprint
+        ltables: list of fact tables (keys of DAGGREGATIONS)
+
+    Returns:
+        dict: Dictionary
+            'StatusCode': [200, 500]
+            'dfs': { table_name: df.dataframe }
+    """
+    logger = logging.getLogger(__name__)
+
+    # Objects already listed by month, chunks do not list the dataset again
+    dpaths = { k: [x["path"] for x in v] for k, v in get_orders_chunks(dobjects.get("orders", [])).items() }
+
+    # Reviews of the window, driven by order keys of every chunk
+    try:
+        df_keys = read_parquet_objects([x for k in dplan['chunks'] for x in dpaths[k]], ['order_id', 'created_datetime'])
+    except Exception as err:
+        return { "StatusCode": 500, "message": f"Failed while trying to read AWS Orders PopAPP keys {err}" }
+    dReviewsResponse = get_rappi_orders_reviews(country, fg_history, df_keys, dobjects.get("reviews"))
+    logger.info(dReviewsResponse["message"])
+    if dReviewsResponse['StatusCode'] != 200:
+        return dReviewsResponse
+    df_reviews = dReviewsResponse['df']
+    del df_keys
+
+    lresponses = []
+    if dplan['strategy'] == 'parallel':
+        lchunks = list(dplan['chunks'])
+        while lchunks:
+            lbatch, lchunks = lchunks[:dplan['n_workers']], lchunks[dplan['n_workers']:]
+            lprocesses = []
+            for year_month in lbatch:
+                parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=_process_orders_chunk_worker,
+                                                  args=(child_conn, df_reviews, country, app, fg_history,
+                                                        year_month, dpaths[year_month], ltables))
+                process.start()
+                child_conn.close()
+                lprocesses.append((year_month, process, parent_conn))
+
+            for year_month, process, parent_conn in lprocesses:
+                try:
+                    lresponses.append(parent_conn.recv())
+                except EOFError:
+                    lresponses.append({ "StatusCode": 500,
+                                        "message": f"Orders chunk { year_month } process ended without response" })
+                process.join()
+    else:
+        for year_month in dplan['chunks']:
+            lresponses.append(process_orders_chunk(df_reviews, country, app, fg_history,
+                                                   year_month, dpaths[year_month], ltables))
+
+    for dresponse in lresponses:
+        if dresponse['StatusCode'] != 200:
+            return dresponse
+
+    dfs = { x: merge_orders_aggregations([dresponse['dfs'][x] for dresponse in lresponses]) for x in ltables }
+    return { "StatusCode": 200, "dfs": dfs }
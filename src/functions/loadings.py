@@ -1,23 +1,270 @@
 import logging
 import datetime
+import hashlib
 import boto3
 
 import awswrangler as wr
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from pyarrow import fs
 
 from config import settings
 from botocore.client import ClientError
 from typing import Set
 
 
-def get_rappi_orders_reviews(country="AR", fg_history=0):
+def get_rappi_reviews_partition_filter(country="AR", fg_history=0, date_from=None):
+    """
+    Partition filter for RAPPI Reviews (country / app / year_month).
+
+    Args:
+        country: ["AR", "CL"], "AR" by default
+        fg_history: [0, 1], 0 by default, means that only read actual and previous month data
+        date_from: date, None by default, only read partitions since that month (semi-join runs)
+
+    Returns:
+        function: receives a dict with partition values and returns bool
+    """
+    logger = logging.getLogger(__name__)
+
+    partition_filter = lambda x: x["country"] == country and x["app"] == "RP"
+    if not fg_history:
+        # If not history run, previous and actual month
+        actualMonth = (datetime.date.today()).strftime("%Y-%m")
+        previousMonth = (datetime.date.today().replace(day=1) - datetime.timedelta(days=1)).strftime("%Y-%m")
+        logger.info(f"Reading Reviews for { actualMonth } and { previousMonth }")
+        partition_filter = lambda x: x["country"] == country and \
+                                     x["app"] == "RP" and \
+                                    (x["year_month"] == previousMonth or x["year_month"] == actualMonth)
+    if date_from:
+        base_filter = partition_filter
+        partition_filter = lambda x: base_filter(x) and x["year_month"] >= date_from.strftime("%Y-%m")
+    return partition_filter
+
+
+def get_order_detail_partition_filter(country="AR", app="RP", fg_history=0):
+    """
+    Partition filter for Orders Detail PopApp (country / app / year / month / day).
+
+    Args:
+        country: ["AR", "CL"], "AR" by default
+        app: ["RP", "PY"], "RP" by default
+        fg_history: [0, 1], 0 by default, means that only read since first day of previous month
+
+    Returns:
+        function: receives a dict with partition values and returns bool
+    """
+    logger = logging.getLogger(__name__)
+
+    app = 'rappi' if app == 'RP' else 'peya'
+
+    partition_filter = lambda x: x["country"] == country and x["app"] == app
+    if not fg_history:
+        # If not history run, previous and actual month
+        lastMonth = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+        date_from = lastMonth.replace(day=1)
+        logger.info(f"Reading Orders since { date_from.strftime('%Y-%m-%d') }")
+        partition_filter = lambda x: x["country"] == country and \
+                                     x["app"] == app and \
+                                     date_from <= datetime.date(int(x["year"]), int(x["month"]), int(x["day"]))
+    return partition_filter
+
+
+def get_path_partitions(path):
+    """
+    Get Hive partition values of an object path.
+
+    Args:
+        path: object path (.../country=AR/app=RP/year_month=2021-06/file.parquet)
+
+    Returns:
+        dict: { partition: value }
+    """
+    return dict(x.split("=", 1) for x in path.split("/")[:-1] if "=" in x)
+
+
+def list_partition_objects(path, partition_filter, subprefix=""):
+    """
+    List S3 objects of a partitioned dataset that pass the partition filter.
+
+    Only the bucket listing is read (no GET per object), so it is cheap
+    compared to loading the dataset.
+
+    Args:
+        path: S3 dataset path (s3://bucket/prefix/)
+        partition_filter: function as used by wr.s3.read_parquet
+        subprefix: leading partitions to narrow the listing (e.g. "country=AR/app=RP/")
+
+    Returns:
+        list: [{'path': str, 'size': int, 'etag': str}, ...]
+    """
+    bucket, _, prefix = path.replace("s3://", "").partition("/")
+    client = boto3.client('s3')
+    paginator = client.get_paginator('list_objects_v2')
+
+    lobjects = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix + subprefix):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if key.endswith("/") or obj['Size'] == 0:
+                continue
+            dpartitions = get_path_partitions(key[len(prefix):])
+            try:
+                if not partition_filter(dpartitions):
+                    continue
+            except (KeyError, ValueError):
+                continue
+            lobjects.append({ "path": f"s3://{bucket}/{key}", "size": obj['Size'], "etag": obj['ETag'] })
+    return lobjects
+
+
+def read_parquet_objects(lpaths, columns=None):
+    """
+    Read already listed Parquet objects, without listing the dataset again.
+
+    Objects are read by partition directory and their Hive partitions added as
+    categorical columns, as wr.s3.read_parquet(dataset=True) does.
+
+    Args:
+        lpaths: list of S3 objects paths (s3://bucket/prefix/k=v/.../file.parquet)
+        columns: list of columns to read, None by default (all columns and partitions)
+
+    Returns:
+        df.dataframe
+    """
+    dgroups = {}
+    for path in lpaths:
+        dgroups.setdefault(path.rsplit("/", 1)[0], []).append(path)
+
+    ldfs = []
+    for lgroup in dgroups.values():
+        df = wr.s3.read_parquet(path=lgroup, columns=columns, use_threads=True)
+        if columns is None:
+            for name, value in get_path_partitions(lgroup[0]).items():
+                df[name] = value
+        ldfs.append(df)
+    if not ldfs:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.concat(ldfs, ignore_index=True)
+    if columns is None:
+        for name in get_path_partitions(lpaths[0]):
+            df[name] = df[name].astype('category')
+    return df
+
+
+def get_inputs_fingerprint(country="AR", app="RP", fg_history=0):
+    """
+    Fingerprint of the input partitions (Reviews and Orders Detail) of a run.
+
+    It changes whenever an object is added, removed or rewritten in any of
+    the selected partitions.
+
+    Args:
+        country: ["AR", "CL"], "AR" by default
+        app: ["RP", "PY"], "RP" by default
+        fg_history: [0, 1], 0 by default
+
+    Returns:
+        dict: Dictionary
+            'StatusCode': [200, 500]
+            'fingerprint': str
+            'objects': dict with listed objects by source ('reviews', 'orders')
+    """
+    try:
+        # Datasets are partitioned by country and app first, only those prefixes are listed
+        dobjects = {
+            "reviews": list_partition_objects(settings.L2_RAPPI_USERS_S3,
+                                              get_rappi_reviews_partition_filter(country, fg_history),
+                                              f"country={country}/app=RP/"),
+            "orders": list_partition_objects(settings.L2_ORDER_DETAIL_POPAPP_S3,
+                                             get_order_detail_partition_filter(country, app, fg_history),
+                                             f"country={country}/app={'rappi' if app == 'RP' else 'peya'}/")
+        }
+
+        hasher = hashlib.sha256()
+        for source in sorted(dobjects):
+            for obj in sorted(dobjects[source], key=lambda x: x["path"]):
+                hasher.update(f"{source}|{obj['path']}|{obj['size']}|{obj['etag']}\n".encode("utf-8"))
+
+        return { "StatusCode": 200, "message": "Inputs fingerprint OK",
+                 "fingerprint": hasher.hexdigest(), "objects": dobjects }
+    except Exception as err:
+        return { "StatusCode": 500, "message": f"Failed while trying to get inputs fingerprint: {err}" }
+
+
+def read_parquet_semi_join(lpaths, lcolumns, key, values, date_col=None, date_from=None):
+    """
+    Read Parquet objects keeping only rows whose key is in values (semi-join).
+
+    Filters are pushed down to the scan (pyarrow.dataset): row groups are pruned
+    with min/max statistics on key range (numeric or temporal keys) and date_col >= date_from (null dates are
+    kept), the remaining rows are filtered with the set of keys before converting to pandas.
+
+    Args:
+        lpaths: list of S3 objects paths (s3://bucket/key)
+        lcolumns: list of columns to read
+        key: key column (e.g. order_id)
+        values: array with keys to keep
+        date_col: date or timestamp column, None by default
+        date_from: datetime, None by default, only rows with date_col >= date_from or null
+
+    Returns:
+        df.dataframe
+    """
+    if not len(lpaths) or not len(values):
+        return pd.DataFrame(columns=lcolumns)
+
+    filesystem = fs.S3FileSystem(region=boto3.session.Session().region_name or "us-east-1")
+    dataset = ds.dataset([x.replace("s3://", "") for x in lpaths], format="parquet", filesystem=filesystem)
+
+    key_type = dataset.schema.field(key).type
+    try:
+        values = pa.array(values).cast(key_type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        values = pa.array(values)
+    filter_ = ds.field(key).isin(values)
+    if pa.types.is_integer(key_type) or pa.types.is_floating(key_type) or pa.types.is_temporal(key_type):
+        # Range first (row-group statistics), then key set. No min_max kernel for strings
+        key_range = pc.min_max(values).as_py()
+        filter_ = (ds.field(key) >= key_range['min']) & \
+                  (ds.field(key) <= key_range['max']) & \
+                  filter_
+
+    if date_col and date_from is not None:
+        date_type = dataset.schema.field(date_col).type
+        date_filter = None
+        if pa.types.is_timestamp(date_type):
+            date_filter = ds.field(date_col) >= pa.scalar(date_from.to_pydatetime(), type=date_type)
+        elif pa.types.is_date(date_type):
+            date_filter = ds.field(date_col) >= pa.scalar(date_from.date(), type=date_type)
+        elif pa.types.is_string(date_type) or pa.types.is_large_string(date_type):
+            # ISO strings keep chronological order
+            date_filter = ds.field(date_col) >= date_from.strftime("%Y-%m-%d")
+        if date_filter is not None:
+            # Rows without date are kept, the key filter decides for them
+            filter_ = filter_ & (date_filter | ~ds.field(date_col).is_valid())
+
+    return dataset.to_table(columns=lcolumns, filter=filter_).to_pandas()
+
+
+def get_rappi_orders_reviews(country="AR", fg_history=0, df_orders=None, lobjects=None):
     """
     Get RAPPI Reviews.-
 
+    If df_orders is given, only reviews of those orders are read (semi-join):
+    partitions since the month of the first order, and rows filtered by
+    reviewed_at and order_id while scanning the Parquet files.
+
     Args:
         country: ["AR", "CL"], "AR" by default
         fg_history: [0, 1], 0 by default, means that only read actual and previous month data
+        df_orders: dataframe with orders (order_id, created_datetime), None by default
+        lobjects: Reviews objects already listed (see get_inputs_fingerprint), None by default
 
     Returns:
         dict: Dictionary
@@ -28,25 +275,33 @@ def get_rappi_orders_reviews(country="AR", fg_history=0):
 
     try:
         path = settings.L2_RAPPI_USERS_S3
+        # Subset of interested Columns
+        lcolumns = ['order_id', 'reviewed_at', 'rating_type', 'score', 'option', 
+                    'score_1', 'score_2', 'score_3', 'score_4', 'score_5']
+
+        if df_orders is None:
+            partition_filter = get_rappi_reviews_partition_filter(country, fg_history)
+            df_reviews = wr.s3.read_parquet(path=path, dataset=True, use_threads=True, partition_filter=partition_filter)
+        elif df_orders.empty:
+            df_reviews = pd.DataFrame(columns=lcolumns)
+        else:
+            # Reviews are made after the order (one day of margin for time zones)
+            date_from = pd.to_datetime(df_orders['created_datetime']).min().floor('D') - pd.Timedelta(days=1)
+            order_ids = df_orders['order_id'].dropna().unique()
+            logger.info(f"Reading Reviews for { len(order_ids) } orders since { date_from.strftime('%Y-%m-%d') }")
 
-        partition_filter = lambda x: x["country"] == country and x["app"] == "RP" 
-        if not fg_history:
-            # If not history run, previous and actual month
-            actualMonth = (datetime.date.today()).strftime("%Y-%m")
-            previousMonth = (datetime.date.today().replace(day=1) - datetime.timedelta(days=1)).strftime("%Y-%m")
-            logger.info(f"Reading Reviews for { actualMonth } and { previousMonth }")
-            partition_filter = lambda x: x["country"] == country and \
-                                         x["app"] == "RP" and \
-                                        (x["year_month"] == previousMonth or x["year_month"] == actualMonth)
+            partition_filter = get_rappi_reviews_partition_filter(country, fg_history, date_from)
+            if lobjects is None:
+                lobjects = list_partition_objects(path, partition_filter, f"country={country}/app=RP/")
+            lpaths = [x["path"] for x in lobjects if partition_filter(get_path_partitions(x["path"]))]
+            df_reviews = read_parquet_semi_join(lpaths, lcolumns, 'order_id', order_ids, 'reviewed_at', date_from)
         
-        df_reviews = wr.s3.read_parquet(path=path, dataset=True, use_threads=True, partition_filter=partition_filter)
+        df_reviews = df_reviews[lcolumns]
         
-        # Subset of interested Columns
-        df_reviews = df_reviews[['order_id', 'reviewed_at', 'rating_type', 'score', 'option', 
-                                 'score_1', 'score_2', 'score_3', 'score_4', 'score_5']]
-        
-        # Group option values
-        df_reviews['option'] = df_reviews['option'].apply(lambda x: settings.DOPTIONS[x] if x in settings.DOPTIONS else x)
+        # Group option values, mapping runs once by category (not by row)
+        df_reviews['option'] = df_reviews['option'].astype('category') \
+                                                   .map(lambda x: settings.DOPTIONS.get(x, x)) \
+                                                   .astype('category')
         df_reviews = df_reviews.rename(columns={'option': 'score_option'})
         
         return { "StatusCode": 200, "message": "RAPPI Reviews OK", "df": df_reviews }
@@ -54,11 +309,14 @@ def get_rappi_orders_reviews(country="AR", fg_history=0):
         return { "StatusCode": 500, "message": f"Failed while trying to read RAPPI Reviews: {err}" }
 
 
-def get_order_product_detail(country="AR", app="RP", fg_history=0):
+def get_order_product_detail(country="AR", app="RP", fg_history=0, lpaths=None):
     """
     Parameters
     ----------
-    path : S3 definition.
+    country : ["AR", "CL"], "AR" by default
+    app : ["RP", "PY"], "RP" by default
+    fg_history : [0, 1], 0 by default
+    lpaths : list of S3 objects paths, None by default, only read those objects (already listed)
 
     Returns
     -------
@@ -69,19 +327,11 @@ def get_order_product_detail(country="AR", app="RP", fg_history=0):
 
     try:
         path = settings.L2_ORDER_DETAIL_POPAPP_S3
-        app = 'rappi' if app == 'RP' else 'peya'
-        
-        partition_filter = lambda x: x["country"] == country and x["app"] == app
-        if not fg_history:
-            # If not history run, previous and actual month
-            lastMonth = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
-            date_from = lastMonth.replace(day=1)
-            logger.info(f"Reading Orders since { date_from.strftime('%Y-%m-%d') }")
-            partition_filter = lambda x: x["country"] == country and \
-                                         x["app"] == app and \
-                                         date_from <= datetime.date(int(x["year"]), int(x["month"]), int(x["day"]))
-            
-        df_orders = wr.s3.read_parquet(path=path, dataset=True, use_threads=True, partition_filter=partition_filter)
+        if lpaths is None:
+            partition_filter = get_order_detail_partition_filter(country, app, fg_history)
+            df_orders = wr.s3.read_parquet(path=path, dataset=True, use_threads=True, partition_filter=partition_filter)
+        else:
+            df_orders = read_parquet_objects(lpaths)
         
         # Subset orders with "product" type
         df_orders_products = df_orders[df_orders['type'] == 'product']
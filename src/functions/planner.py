@@ -0,0 +1,138 @@
+import logging
+import os
+import re
+
+from config import settings
+
+
+STRATEGIES = ["in_memory", "chunked", "parallel"]
+
+
+def get_available_resources():
+    """
+    Get memory (MB) and vCPUs available for the run.
+
+    On Lambda memory is taken from AWS_LAMBDA_FUNCTION_MEMORY_SIZE, otherwise
+    from the physical memory of the host.
+
+    Returns
+    -------
+    dict.
+        'memory_mb': int
+        'vcpus': int
+    """
+    memory_mb = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if memory_mb:
+        memory_mb = int(memory_mb)
+    else:
+        memory_mb = int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**2)
+
+    if hasattr(os, "sched_getaffinity"):
+        vcpus = len(os.sched_getaffinity(0))
+    else:
+        vcpus = os.cpu_count() or 1
+
+    return { "memory_mb": memory_mb, "vcpus": vcpus }
+
+
+def get_orders_chunks(lorders):
+    """
+    Group Orders Detail objects by month partition (year / month).
+
+    Parameters
+    ----------
+    lorders : list of objects [{'path', 'size', ...}] (see list_partition_objects)
+
+    Returns
+    -------
+    dict.
+        { "YYYY-MM": [objects], ... }
+    """
+    dchunks = {}
+    for obj in lorders:
+        year = re.search(r"/year=(\d+)/", obj["path"])
+        month = re.search(r"/month=(\d+)/", obj["path"])
+        if not (year and month):
+            continue
+        chunk = f"{int(year.group(1)):04d}-{int(month.group(1)):02d}"
+        dchunks.setdefault(chunk, []).append(obj)
+    return dict(sorted(dchunks.items()))
+
+
+def plan_execution(dobjects, strategy=None):
+    """
+    Choose the execution strategy from inputs size and available resources.
+
+    Strategies:
+        in_memory - single pass, both datasets loaded at once
+        chunked - reviews of the window read once, orders streamed by month partition
+        parallel - as chunked, with months processed by up to vCPUs processes
+
+    Sizes are estimated from the Parquet objects listed for the selected
+    partitions times settings.PLANNER_EXPANSION_FACTOR (decompression plus
+    merge and copies while processing).
+
+    Parameters
+    ----------
+    dobjects : dict with listed objects by source ('reviews', 'orders'), see get_inputs_fingerprint
+    strategy : force strategy, None by default
+
+    Returns
+    -------
+    dict.
+        'strategy': str
+        'n_workers': int
+        'chunks': list of "YYYY-MM" months (empty for in_memory)
+        'estimates': dict with input sizes, estimated and available memory (MB)
+    """
+    logger = logging.getLogger(__name__)
+
+    dresources = get_available_resources()
+    dchunks = get_orders_chunks(dobjects.get("orders", []))
+
+    reviews_mb = sum(x["size"] for x in dobjects.get("reviews", [])) / 1024**2
+    orders_mb = sum(x["size"] for x in dobjects.get("orders", [])) / 1024**2
+    max_chunk_mb = max((sum(x["size"] for x in lobjects) for lobjects in dchunks.values()), default=0) / 1024**2
+
+    factor = settings.PLANNER_EXPANSION_FACTOR
+    budget_mb = dresources["memory_mb"] * settings.PLANNER_MEMORY_FRACTION
+    estimated_mb = (reviews_mb + orders_mb) * factor
+    estimated_chunk_mb = (reviews_mb + max_chunk_mb) * factor
+
+    # Workers share reviews (fork), each one holds a month of orders
+    n_workers = min(dresources["vcpus"], len(dchunks), settings.PLANNER_MAX_WORKERS)
+    while n_workers > 1 and (reviews_mb + n_workers * max_chunk_mb) * factor > budget_mb:
+        n_workers -= 1
+
+    if strategy not in STRATEGIES:
+        if strategy:
+            logger.warning(f"Strategy { strategy } not supported, it will be estimated")
+        if estimated_mb <= budget_mb or len(dchunks) <= 1:
+            strategy = "in_memory"
+        elif n_workers > 1:
+            strategy = "parallel"
+        else:
+            strategy = "chunked"
+    if not dchunks:
+        # Without month partitions listed there is nothing to stream
+        strategy = "in_memory"
+
+    dplan = {
+        "strategy": strategy,
+        "n_workers": max(n_workers, 1) if strategy == "parallel" else 1,
+        "chunks": list(dchunks) if strategy != "in_memory" else [],
+        "estimates": {
+            "reviews_objects": len(dobjects.get("reviews", [])),
+            "orders_objects": len(dobjects.get("orders", [])),
+            "reviews_mb": round(reviews_mb, 2),
+            "orders_mb": round(orders_mb, 2),
+            "max_chunk_mb": round(max_chunk_mb, 2),
+            "estimated_mb": round(estimated_mb, 2),
+            "estimated_chunk_mb": round(estimated_chunk_mb, 2),
+            "budget_mb": round(budget_mb, 2),
+            "memory_mb": dresources["memory_mb"],
+            "vcpus": dresources["vcpus"]
+        }
+    }
+    logger.info(f"Execution plan: { dplan }")
+    return dplan
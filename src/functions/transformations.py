@@ -10,7 +10,7 @@ import awswrangler as wr
 import pandas as pd
 import numpy as np
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 
 from config import settings
 from botocore.client import ClientError
@@ -48,7 +48,7 @@ def process_orders_slot_time(df_orders):
         return { "StatusCode": 500, "message": f"Failed while trying to process Orders Slot Time: {err}" }
 
 
-def process_orders_reviews_products(df):
+def process_orders_reviews_products(df, fg_filter=True):
     """
     Based on orders by date, slottime, country, branch, brand, products.. get aggregations.
     
@@ -59,6 +59,8 @@ def process_orders_reviews_products(df):
     Parameters
     ----------
     df : dataframe with reviews by products
+    fg_filter : apply products filter (see filter_orders_reviews_products), 
+                False for partial aggregations (chunks) to filter after concat
 
     Returns
     -------
@@ -94,30 +96,50 @@ def process_orders_reviews_products(df):
         df_scores_['n_reviews'] = df_scores_[list(df_scores_.filter(regex='score'))].sum(axis=1).astype(int)
         # Convert to date
         df_scores_['date'] = pd.to_datetime(df_scores_['date'])
-        # Get Days from min and max day sale product
-        df_scores_["days_product"] = df_scores_.groupby("product_name")['date'].transform(lambda x: (x.max()-x.min()).days)
-    
-        # Generate Reviews and Days in product to get coefficient
-        df_product_coeff = df_scores_.groupby("product_name").agg(
-            # Get sum of scores
-            n_reviews=('n_reviews', 'sum'),
-            days_product=('days_product', 'first')
-        ).reset_index()
-        df_product_coeff['coeff'] = df_product_coeff['days_product'] / df_product_coeff['n_reviews']
-        
-        # Cutoff based on distribution:
-        # 10%: 1.04, 20%: 2.21, 30%: 4.24, 40%: 7.18, 50%: 10.18
-        df_products_ = df_product_coeff[df_product_coeff['coeff'] >= 4]
-        df_products_ = df_products_[df_products_['n_reviews'] > 4]
-        
-        df_scores_ = df_scores_[df_scores_['product_name'].isin(list(df_products_['product_name']))]
-        del df_scores_["days_product"]
+
+        if fg_filter:
+            df_scores_ = filter_orders_reviews_products(df_scores_)
         
         return { "StatusCode": 200, "df": df_scores_ }
     except Exception as err:
         return { "StatusCode": 500, "message": f"Failed while trying to process Orders with Reviews by Products {err}" }
 
 
+def filter_orders_reviews_products(df_scores_):
+    """
+    Keep products with enough reviews along the days they were sold.
+
+    Parameters
+    ----------
+    df_scores_ : dataframe with aggregations by products (process_orders_reviews_products)
+
+    Returns
+    -------
+    dataframe.
+    """
+    df_scores_ = df_scores_.copy()
+    # Get Days from min and max day sale product
+    df_scores_["days_product"] = df_scores_.groupby("product_name")['date'].transform(lambda x: (x.max()-x.min()).days)
+    
+    # Generate Reviews and Days in product to get coefficient
+    df_product_coeff = df_scores_.groupby("product_name").agg(
+        # Get sum of scores
+        n_reviews=('n_reviews', 'sum'),
+        days_product=('days_product', 'first')
+    ).reset_index()
+    df_product_coeff['coeff'] = df_product_coeff['days_product'] / df_product_coeff['n_reviews']
+    
+    # Cutoff based on distribution:
+    # 10%: 1.04, 20%: 2.21, 30%: 4.24, 40%: 7.18, 50%: 10.18
+    df_products_ = df_product_coeff[df_product_coeff['coeff'] >= 4]
+    df_products_ = df_products_[df_products_['n_reviews'] > 4]
+    
+    df_scores_ = df_scores_[df_scores_['product_name'].isin(list(df_products_['product_name']))]
+    del df_scores_["days_product"]
+    
+    return df_scores_
+
+
 def process_orders_reviews_errors(df):
     """
     Based on orders by date, slottime, country, branch, brand, score_option.. get aggregations.
@@ -230,24 +252,49 @@ def process_orders_reviews(df):
         return { "StatusCode": 500, "message": f"Failed while trying to process Orders with Scores {err}" }
 
 
-def save_postgre(df, table_name, lnumerics, ldates, fg_history):
+def get_postgre_engine():
+    """
+        Postgres DB engine
+    """
+    return create_engine(f'postgresql://{settings.PG_USERNAME}:{settings.PG_PASSWORD}@{settings.PG_HOST}:{settings.PG_PORT}/{settings.PG_DATABASE}')
+
+
+def save_postgre(df, table_name, lnumerics, ldates, fg_history, dcolumns=None):
     """
         Function to Store info in Postgres DB
+
+        On history runs an existing table is truncated (not dropped) to keep
+        the views built over it. If dcolumns ({ column: postgres type }) is given,
+        the table is created if not exists with that DDL, so concurrent first
+        runs only append to the same table.
     """
     logger = logging.getLogger(__name__)
 
     logger.info("Trying to save in Postgres")
-    engine = create_engine(f'postgresql://{settings.PG_USERNAME}:{settings.PG_PASSWORD}@{settings.PG_HOST}:{settings.PG_PORT}/{settings.PG_DATABASE}')
+    engine = get_postgre_engine()
 
     # CAST
     df[lnumerics] = df[lnumerics].apply(pd.to_numeric)
     df[ldates] = df[ldates].apply(pd.to_datetime)
 
+    if dcolumns:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), { "name": table_name })
+                columns = ", ".join(f"{x} {t}" for x, t in dcolumns.items())
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns})")
+        except Exception as err:
+            return { "StatusCode": 500, "message": f"Failed while trying to create table {table_name} {err}" }
+
     if fg_history:
         try:
             # Connect to Database adHoc
             conn = engine.connect()
-            df.to_sql(table_name, engine, if_exists='replace', index=False, method="multi")
+            if inspect(engine).has_table(table_name):
+                conn.execute(f"TRUNCATE TABLE {table_name}")
+                df.to_sql(table_name, engine, if_exists='append', index=False, method="multi")
+            else:
+                df.to_sql(table_name, engine, if_exists='replace', index=False, method="multi")
             return { "StatusCode": 200, "message": "OK" }
         except Exception as err:
             return { "StatusCode": 500, "message": f"Failed while trying to Save Postgres {err}" }
@@ -10,16 +10,19 @@ import numpy as np
 
 from config import settings
 
-from functions.loadings import \
-    get_rappi_orders_reviews, \
-    get_order_product_detail
+from functions.loadings import get_inputs_fingerprint
 from functions.transformations import \
-    process_orders_slot_time, \
-    process_orders_reviews, \
-    process_orders_reviews_errors, \
-    process_orders_reviews_products, \
+    filter_orders_reviews_products, \
+    get_postgre_engine, \
     save_postgre
 from functions.ingestion import update_quicksight_datasets
+from functions.checkpoints import StageCheckpoint
+from functions.planner import plan_execution
+from functions.dimensions import DFACTS, DimensionLookup, create_fact_views
+from functions.executions import \
+    get_orders_slot_time, \
+    process_orders_aggregations, \
+    process_orders_by_chunks
 
 
 pd.options.mode.chained_assignment = None 
@@ -36,6 +39,12 @@ c_handler.setFormatter(c_format)
 # Add handler to logger
 logger.addHandler(c_handler)
 
+# Fact tables populated by this ETL (also checkpoint stages). They are stored with
+# surrogate keys in "<name>_keys" tables and exposed with the wide shape as views "<name>"
+FACT_TABLES = ['fct_ops_orders_score_slottime', 
+               'fct_ops_orders_score_slottime_options', 
+               'fct_ops_orders_score_slottime_products']
+
 
 def lambda_handler(event, context):
     """
@@ -50,10 +59,13 @@ def lambda_handler(event, context):
             fg_history: boolean|integer
             country: country
             app: app ["rappi", "peya"]
+            checkpoint_path: optional, local dir or S3 prefix for stage checkpoints
+            checkpoint_format: optional, ["parquet", "arrow"]
+            strategy: optional, force execution strategy ["in_memory", "chunked", "parallel"]
         }
 
         Tables in l3 (postgres): 
-        - ops means Operations
+        - ops means Operations (stored as *_keys with dim_ops_*** surrogate keys, exposed as views)
             Reviews por Momento del día (fct_ops_***)
                 fct_ops_orders_score_slottime
             Reviews con Apertura (Producto/Key Points) (fct_ops_***)
@@ -67,6 +79,7 @@ def lambda_handler(event, context):
         {
             statusCode: *200|500*
             body: *ERROR message or Description*
+            plan: *execution plan with estimates (strategy, chunks, sizes, memory, vCPUs)*
         }
     """
 
@@ -84,98 +97,156 @@ def lambda_handler(event, context):
 
         logger.info(f"Input params - country: {country} - app: {app} - HISTORY: {bool(fg_history)}")
         
-        # Call to get reviews
-        dReviewsResponse = get_rappi_orders_reviews(country, fg_history)
-        logger.info(dReviewsResponse["message"])
-        # Call to get orders detail
-        dOrdersResponse = get_order_product_detail(country, app, fg_history)
-        logger.info(dOrdersResponse["message"])
-
-        # StatusCode Definition
-        status_code = 200 if ((dReviewsResponse['StatusCode']==200) & \
-                              (dOrdersResponse['StatusCode']==200)) else 500
-
-        if status_code == 200:
-            df = pd.merge(dOrdersResponse['df'], dReviewsResponse['df'], how="left", on="order_id")
-            # Process Slottime
-            dresponse = process_orders_slot_time(df)
-
-            if dresponse['StatusCode'] == 200:
-                df = dresponse['df']
-
-                ######################################
-                # Orders and Reviews Slottime: GRAL
-                dresponse = process_orders_reviews(df)
-                df_orders_score_slottime = dresponse['df']
-                df_orders_score_slottime['score_n_orders']= df_orders_score_slottime[list(df_orders_score_slottime.filter(regex='score'))].sum(axis=1).astype(int)
-                df_orders_score_slottime['app'] = app
-
-                # List of Numeric Columns
-                lnumerics = ["branch_id", "brand_id", "weekday", "n_orders", "score_n_orders", 
-                            "score_1", "score_2", "score_3", "score_4", "score_5"]
-                # List of Date Columns
-                ldates = ["date"]
-
-                dresponse = save_postgre(df_orders_score_slottime, 
-                                        'fct_ops_orders_score_slottime', 
-                                        lnumerics, 
-                                        ldates, 
-                                        fg_history)
-                logger.info(dresponse['message'])
-
-                ######################################
-                # Reviews with ERROR TYPE Definition
-                dresponse = process_orders_reviews_errors(df)
-                df_orders_score_slottime_options = dresponse['df']
-                df_orders_score_slottime_options['app'] = app
-
-                # List of Numeric Columns
-                lnumerics = ["branch_id", "brand_id", "weekday", "n_reviews", 
-                            "score_1", "score_2", "score_3", "score_4", "score_5"]
-                # List of Date Columns
-                ldates = ["date"]
-
-                dresponse = save_postgre(df_orders_score_slottime_options, 
-                                        'fct_ops_orders_score_slottime_options', 
-                                        lnumerics, 
-                                        ldates, 
-                                        fg_history)
-                logger.info(dresponse['message'])
-
-                #######################################
-                # Reviews with PRODUCTs
-                dresponse = process_orders_reviews_products(df)
-                df_orders_score_slottime_products = dresponse['df']
-                df_orders_score_slottime_products['app'] = app
-
-                # List of Numeric Columns
-                lnumerics = ["branch_id", "brand_id", "weekday", "n_reviews", 
-                            "score_1", "score_2", "score_3", "score_4", "score_5"]
-                # List of Date Columns
-                ldates = ["date"]
-
-                dresponse = save_postgre(df_orders_score_slottime_products, 
-                                        'fct_ops_orders_score_slottime_products', 
-                                        lnumerics, 
-                                        ldates, 
-                                        fg_history)
-                logger.info(dresponse['message'])
-
-
-                # Update ops datasets
-                input_ingestion = { 'datasets': ['fct_ops_'] }
-                response = update_quicksight_datasets(input_ingestion)
-                if response["StatusCode"] == 200:
-                    logger.info(response["message"])
-                    return { "StatusCode": 200, "message": "OK"}
-                else:
-                    return { "StatusCode": 500, "message": f"{ response['message'] }" }
+        # Inputs listing: fingerprint for checkpoints and sizes for the execution plan
+        dInputsResponse = get_inputs_fingerprint(country, app, fg_history)
+        logger.info(dInputsResponse["message"])
+
+        # Checkpoints (optional): a retry with the same inputs resumes from the last completed stage
+        checkpoint_path = event.get("checkpoint_path", settings.CHECKPOINT_PATH)
+        if dInputsResponse["StatusCode"] != 200:
+            checkpoint_path = None
+
+        checkpoint = StageCheckpoint(checkpoint_path,
+                                     { "country": country, "app": app, "fg_history": fg_history,
+                                       "date": datetime.date.today().strftime("%Y-%m-%d") },
+                                     dInputsResponse.get("fingerprint", ""),
+                                     event.get("checkpoint_format"))
+        if checkpoint.enabled:
+            logger.info(f"Checkpoints in { checkpoint.path } - completed stages: { list(checkpoint.manifest['stages']) }")
+
+        # Aggregations already completed, the rest are processed following the execution plan
+        daggregates = { x: checkpoint.load(x) for x in FACT_TABLES }
+        lpending = [x for x in FACT_TABLES if daggregates[x] is None]
+        dplan = None
+
+        if lpending:
+            dplan = plan_execution(dInputsResponse.get("objects", {}), event.get("strategy"))
+
+            if dplan["strategy"] == "in_memory":
+                # Orders and Reviews with Slottime
+                df = checkpoint.load("orders_slot_time")
+                if df is None:
+                    dresponse = get_orders_slot_time(country, app, fg_history, dInputsResponse.get("objects"))
+                    if dresponse['StatusCode'] != 200:
+                        return { "StatusCode": 500, "message": dresponse['message'], "plan": dplan }
+                    df = dresponse['df']
+                    checkpoint.save("orders_slot_time", df)
+                dresponse = process_orders_aggregations(df, lpending)
+            else:
+                dresponse = process_orders_by_chunks(country, app, fg_history, dplan,
+                                                     dInputsResponse.get("objects", {}), lpending)
 
+            if dresponse['StatusCode'] != 200:
+                return { "StatusCode": 500, "message": dresponse['message'], "plan": dplan }
+            daggregates.update(dresponse['dfs'])
 
-            else:
-                return { "StatusCode": 500, "message": dresponse['message'] }
-        else:
-            return { "StatusCode": 500, "message": "ERROR while trying to get Reviews or Orders" }
+            if 'fct_ops_orders_score_slottime' in lpending:
+                df_orders_score_slottime = daggregates['fct_ops_orders_score_slottime']
+                df_orders_score_slottime['score_n_orders']= df_orders_score_slottime[list(df_orders_score_slottime.filter(regex='score'))].sum(axis=1).astype(int)
+            if 'fct_ops_orders_score_slottime_products' in lpending:
+                daggregates['fct_ops_orders_score_slottime_products'] = \
+                    filter_orders_reviews_products(daggregates['fct_ops_orders_score_slottime_products'])
+
+            for table_name in lpending:
+                daggregates[table_name]['app'] = app
+                checkpoint.save(table_name, daggregates[table_name])
+
+        ######################################
+        # Dimensions (dim_ops_***): new members upserted once, facts keep only surrogate keys
+        engine = get_postgre_engine()
+        lloads = [x for x in FACT_TABLES if not checkpoint.is_done(f'load_{x}')]
+        dfacts = {}
+        if lloads:
+            dimensions = DimensionLookup(engine)
+            dresponse = dimensions.upsert([daggregates[x] for x in lloads])
+            logger.info(dresponse['message'])
+            if dresponse['StatusCode'] != 200:
+                return { "StatusCode": 500, "message": dresponse['message'], "plan": dplan }
+            dfacts = { x: dimensions.resolve(daggregates[x]) for x in lloads }
+
+        ######################################
+        # Orders and Reviews Slottime: GRAL
+        # List of Numeric Columns
+        lnumerics = ["branch_key", "brand_key", "slot_key", "n_orders", "score_n_orders", 
+                    "score_1", "score_2", "score_3", "score_4", "score_5"]
+        # List of Date Columns
+        ldates = ["date"]
+
+        if not checkpoint.is_done('load_fct_ops_orders_score_slottime'):
+            dresponse = save_postgre(dfacts['fct_ops_orders_score_slottime'], 
+                                    'fct_ops_orders_score_slottime_keys', 
+                                    lnumerics, 
+                                    ldates, 
+                                    fg_history,
+                                    DFACTS['fct_ops_orders_score_slottime_keys'])
+            logger.info(dresponse['message'])
+            if dresponse['StatusCode'] != 200:
+                return { "StatusCode": 500, "message": dresponse['message'], "plan": dplan }
+            checkpoint.mark_done('load_fct_ops_orders_score_slottime')
+
+        ######################################
+        # Reviews with ERROR TYPE Definition
+        # List of Numeric Columns
+        lnumerics = ["branch_key", "brand_key", "slot_key", "option_key", "n_reviews", 
+                    "score_1", "score_2", "score_3", "score_4", "score_5"]
+        # List of Date Columns
+        ldates = ["date"]
+
+        if not checkpoint.is_done('load_fct_ops_orders_score_slottime_options'):
+            dresponse = save_postgre(dfacts['fct_ops_orders_score_slottime_options'], 
+                                    'fct_ops_orders_score_slottime_options_keys', 
+                                    lnumerics, 
+                                    ldates, 
+                                    fg_history,
+                                    DFACTS['fct_ops_orders_score_slottime_options_keys'])
+            logger.info(dresponse['message'])
+            if dresponse['StatusCode'] != 200:
+                return { "StatusCode": 500, "message": dresponse['message'], "plan": dplan }
+            checkpoint.mark_done('load_fct_ops_orders_score_slottime_options')
+
+        #######################################
+        # Reviews with PRODUCTs
+        # List of Numeric Columns
+        lnumerics = ["branch_key", "brand_key", "slot_key", "product_key", "n_reviews", 
+                    "score_1", "score_2", "score_3", "score_4", "score_5"]
+        # List of Date Columns
+        ldates = ["date"]
+
+        if not checkpoint.is_done('load_fct_ops_orders_score_slottime_products'):
+            dresponse = save_postgre(dfacts['fct_ops_orders_score_slottime_products'], 
+                                    'fct_ops_orders_score_slottime_products_keys', 
+                                    lnumerics, 
+                                    ldates, 
+                                    fg_history,
+                                    DFACTS['fct_ops_orders_score_slottime_products_keys'])
+            logger.info(dresponse['message'])
+            if dresponse['StatusCode'] != 200:
+                return { "StatusCode": 500, "message": dresponse['message'], "plan": dplan }
+            checkpoint.mark_done('load_fct_ops_orders_score_slottime_products')
+
+        #######################################
+        # Every load stage is done at this point (a failed one returns above), so views
+        # and Quicksight datasets are only updated over complete fact tables
+
+        # Views with the wide shape (dimension attributes) for dashboards
+        if not checkpoint.is_done('create_fact_views'):
+            dresponse = create_fact_views(engine, { x: f"{x}_keys" for x in FACT_TABLES })
+            logger.info(dresponse['message'])
+            if dresponse['StatusCode'] != 200:
+                return { "StatusCode": 500, "message": dresponse['message'], "plan": dplan }
+            checkpoint.mark_done('create_fact_views')
+
+
+        # Update ops datasets
+        if not checkpoint.is_done('update_quicksight_datasets'):
+            input_ingestion = { 'datasets': ['fct_ops_'] }
+            response = update_quicksight_datasets(input_ingestion)
+            if response["StatusCode"] != 200:
+                return { "StatusCode": 500, "message": f"{ response['message'] }", "plan": dplan }
+            logger.info(response["message"])
+            checkpoint.mark_done('update_quicksight_datasets')
+
+        return { "StatusCode": 200, "message": "OK", "plan": dplan }
     except BaseException as err:
         logging.critical("Exception raised: %s", str(err), exc_info=True)
         return {"statusCode": 500, "body": "ERROR"}
\ No newline at end of file